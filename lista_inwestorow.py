@@ -2,17 +2,39 @@ import streamlit as st
 import pandas as pd
 import requests
 import time
-import random
 import io
-from typing import List, Dict, Optional
+import json
+import re
+import itertools
+import threading
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from typing import Callable, Deque, Iterable, Iterator, List, Dict, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Sprawdź czy openpyxl jest zainstalowane
+# orjson dekoduje odpowiedzi API kilka razy szybciej niż moduł json
 try:
-    import openpyxl
+    import orjson
 except ImportError:
-    import subprocess, sys
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "openpyxl"])
-    import openpyxl
+    orjson = None
+
+# xlsxwriter zapisuje arkusz strumieniowo (constant_memory) - bez niego zostaje openpyxl
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# diskcache zachowuje wyniki lookupów (płatnych) i wyszukiwań między restartami aplikacji
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 
 # Definicje list wyboru
 DEPARTMENTS = [
@@ -104,8 +126,228 @@ DEPARTMENTS_TO_EXCLUDE = [
     "Pipeline", "Education", "Administration", "Professor", "Teacher", "Researcher"
 ]
 
+# Ilu kandydatów z jednego wyszukiwania bierzemy do lookupu
+CANDIDATES_PER_SEARCH = 15
+
+# Rozmiar strony wyszukiwania - każdy etap bierze najwyżej CANDIDATES_PER_SEARCH
+# profili, więc więcej nie pobieramy
+SEARCH_PAGE_SIZE = CANDIDATES_PER_SEARCH
+
+# Limit czasu pojedynczego zapytania (połączenie, odczyt) - zawieszone połączenie
+# nie blokuje wątku roboczego w nieskończoność
+REQUEST_TIMEOUT = (5, 30)
+
+# Limit API: średnio 5 zapytań na sekundę, maksymalnie 5 naraz
+RATE_LIMIT_PER_SEC = 5.0
+RATE_LIMIT_BURST = 5
+
+# AIMD: po 429 tempo spada o połowę (nie niżej niż minimum), po każdych
+# RATE_RECOVERY_EVERY udanych zapytaniach rośnie o RATE_RECOVERY_STEP
+RATE_LIMIT_MIN_PER_SEC = 0.5
+RATE_RECOVERY_EVERY = 10
+RATE_RECOVERY_STEP = 0.2
+
+# Najdłuższa przerwa z X-RateLimit-Reset - reset dziennego/miesięcznego limitu nie
+# zamraża wątków na godziny; po przerwie ewentualne 429 obsłuży zwykła ścieżka
+RATE_LIMIT_MAX_COOLDOWN = 300
+
+# Ile domen przetwarzamy równolegle (tempo i tak pilnuje limiter API)
+MAX_WORKERS = 4
+# Każda domena zleca naraz najwyżej 3 lookupy
+LOOKUP_WORKERS = MAX_WORKERS * 3
+
+# Ile wyników lookupu i wyszukiwania trzymamy w pamięci
+LOOKUP_CACHE_SIZE = 4096
+SEARCH_CACHE_SIZE = 1024
+
+# Cache lookupów i wyszukiwań na dysku (jeśli jest diskcache) - katalog i czas ważności wpisu
+DISK_CACHE_DIR = ".rr_cache"
+DISK_CACHE_TTL = 7 * 24 * 3600
+
+# Ile ostatnich raportów domen pokazujemy w logu na żywo
+LOG_LINES = 50
+
+# Ile wierszy wyników pokazujemy w tabeli - pełne dane są w pliku Excel
+PREVIEW_ROWS = 100
+
+# Co ile ukończonych domen odświeżamy podgląd częściowych wyników
+PARTIAL_EVERY = 10
+
+# Pasek postępu i log odświeżamy najwyżej co tyle sekund (~10 Hz) - każde
+# odświeżenie to osobna wiadomość do przeglądarki
+UI_REFRESH_INTERVAL = 0.1
+
+# Kolejność jakości emaili z RocketReach (mniej = lepiej)
+_GRADE_ORDER = {"A": 1, "A-": 2, "B": 3, "B-": 4, "C": 5, "D": 6, "F": 7}
+
+# Kolumny wyniku dla każdej z 3 osób: (nagłówek, klucz w słowniku kontaktu)
+CONTACT_FIELDS = (("Name", "name"), ("Title", "title"), ("Email", "email"),
+                  ("LinkedIn", "linkedin"), ("Grade", "email_grade"))
+# Nagłówki kolumn i klucze dla 1., 2. i 3. osoby - liczone raz, nie przy każdym wierszu
+CONTACT_SLOTS = [[(f"{col} {i}", key) for col, key in CONTACT_FIELDS] for i in range(1, 4)]
+RESULT_COLUMNS = ["Website", "Status"] + [name for slot in CONTACT_SLOTS for name, _ in slot]
+
+
+@dataclass(slots=True)
+class Candidate:
+    """Profil zwrócony przez person/search (przed lookupem emaila)"""
+    id: int
+    name: str
+    title: str
+    linkedin: str
+    management_level: str
+
+
+@dataclass
+class RunContext:
+    """Stan jednego wyszukiwania - klient API jest wspólny dla wszystkich sesji, ten obiekt nie"""
+    # Wymuszone odświeżenie: cache nie jest czytany, ale nadal zapisywany
+    refresh: bool = False
+    # Ile zapytań obsłużył cache - tyle kredytów i round-tripów zaoszczędzono
+    cache_hits: int = 0
+    # Przy odświeżaniu: wyniki pobrane w tym uruchomieniu - osoba z kilku etapów to dalej jeden lookup
+    fresh: Dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+
+# Kropka na końcu (FQDN, np. "example.com.") nie należy do hosta - inaczej _HOST_RE by go odrzucił
+_DOMAIN_RE = re.compile(r"^(?:https?://)?(?:[^@/?#]*@)?(?:www\.)?([^/:?#]*?)\.?(?=[/:?#]|$)")
+# Host, który w ogóle może być domeną: etykiety z liter/cyfr/myślników i TLD (także IDN)
+_HOST_RE = re.compile(r"(?:[^\W_](?:[\w-]{0,61}[^\W_])?\.)+(?:[^\W\d_]{2,}|xn--[a-z0-9-]+)")
+
+
+@lru_cache(maxsize=4096)
+def extract_domain(url: str) -> str:
+    """Sam host z adresu strony - bez schematu, user@, www., końcowej kropki, portu, ścieżki i query, małymi literami"""
+    return _DOMAIN_RE.match(url.strip().lower()).group(1)
+
+
+def _json(resp: requests.Response):
+    """Zdekoduj odpowiedź API (orjson, jeśli jest zainstalowany)"""
+    if orjson is not None:
+        try:
+            return orjson.loads(resp.content)
+        except orjson.JSONDecodeError as e:
+            # Jak resp.json() - błąd jest RequestException i kończy tylko tę domenę
+            raise requests.exceptions.InvalidJSONError(str(e), response=resp) from e
+    return resp.json()
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """Sekundy z nagłówka Retry-After - podanego jako liczba sekund albo data HTTP"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _dumps(payload: Dict) -> bytes:
+    """Zakoduj payload zapytania (orjson, jeśli jest zainstalowany)"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
+
+class LRUCache:
+    """Cache LRU o ograniczonym rozmiarze, bezpieczny dla wielu wątków"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenBucket:
+    """Token bucket współdzielony przez wątki - acquire() czeka, aż będzie wolny żeton.
+    Tempo dostosowuje się do serwera (AIMD): slow_down() po 429, success() po udanym zapytaniu."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._successes = 0
+        # Do kiedy kolejne 429 należą do tego samego zdarzenia (monotonic)
+        self._hold_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        # Żetony naliczone po dotychczasowym tempie, zanim cokolwiek je zmieni
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        # Pod blokadą tylko pobieramy żeton (saldo może zejść poniżej zera - to kolejka
+        # oczekujących), a czekamy już poza nią, żeby śpiący wątek nie wstrzymywał innych
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float):
+        # Nowy limit z planu API; tempo zdławione po 429 zostaje zdławione, ale nie ponad limit
+        with self._lock:
+            self._refill()
+            throttled = self.rate < self.max_rate
+            self.max_rate = rate
+            self.rate = min(self.rate, rate) if throttled else rate
+
+    def slow_down(self, hold: float):
+        # 429 z kilku wątków naraz to jedno zdarzenie - tempo spada o połowę raz
+        # na okno przerwy (hold sekund), a nie przy każdej odpowiedzi
+        with self._lock:
+            now = time.monotonic()
+            if now < self._hold_until:
+                return
+            self._hold_until = now + max(hold, 1.0)
+            self._refill()
+            self.rate = max(RATE_LIMIT_MIN_PER_SEC, self.rate / 2)
+            self._successes = 0
+
+    def success(self):
+        with self._lock:
+            if self.rate >= self.max_rate:
+                return
+            self._successes += 1
+            if self._successes % RATE_RECOVERY_EVERY == 0:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + RATE_RECOVERY_STEP)
+
+
 class RocketReachAPI:
-    def __init__(self, api_key: str, strict_backoff: bool = True):
+    def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = "https://api.rocketreach.co/api/v2"
         self.headers = {
@@ -113,42 +355,114 @@ class RocketReachAPI:
             "Content-Type": "application/json",
             "accept": "application/json"
         }
-        self.strict_backoff = strict_backoff
-        self.request_timestamps: List[float] = []
+        # Jedna sesja = pula połączeń keep-alive, bez nowego TCP/TLS przy każdym zapytaniu.
+        # Retry na poziomie urllib3 z wykładniczym backoffem: błędy połączenia (zapytanie
+        # nie wyszło) i przejściowe 502/503/504 - search i lookup są tylko odczytem, więc
+        # POST też można powtórzyć. 429 i Retry-After obsługuje _handle_rate_limit,
+        # bo przerwa musi dotyczyć wszystkich wątków naraz
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        retry = Retry(total=3, connect=3, read=0, status=3, backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET", "POST"}),
+                      respect_retry_after_header=False, raise_on_status=False)
+        # Pula połączeń na tyle duża, by każdy wątek (domeny + lookupy) miał własne
+        # połączenie - domyślne 10 oznaczałoby zamykanie nadmiarowych po każdym użyciu
+        self.session.mount("https://", HTTPAdapter(pool_connections=1,
+                                                   pool_maxsize=MAX_WORKERS + LOOKUP_WORKERS,
+                                                   max_retries=retry))
+        # Jeden limit dla wszystkich wątków tej instancji
+        self.bucket = TokenBucket(RATE_LIMIT_PER_SEC, RATE_LIMIT_BURST)
+        # Po 429 wszystkie zapytania czekają do wspólnego terminu
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+        # Wątki robocze nie mogą wołać st.* - komunikaty (poziom, treść)
+        # trafiają tutaj i renderuje je wątek główny
+        self.notices: Deque[Tuple[str, str]] = deque()
+        # Wspólna pula dla lookupów wszystkich domen
+        self._lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+        # Ta sama osoba wraca w kilku etapach - lookup kosztuje kredyt, więc pamiętamy wynik
+        self.lookup_cache = LRUCache(LOOKUP_CACHE_SIZE)
+        # Profile z wyszukiwania po (domena, pole, wartości, filtry) - ponowne uruchomienie
+        # z tymi samymi danymi nie odpytuje API drugi raz
+        self.search_cache = LRUCache(SEARCH_CACHE_SIZE)
+        self.disk_cache = diskcache.Cache(DISK_CACHE_DIR) if diskcache is not None else None
+
+    def _notify(self, level: str, message: str):
+        self.notices.append((level, message))
+
+    def drain_notices(self) -> List[Tuple[str, str]]:
+        """Zwróć i wyczyść komunikaty zebrane przez wątki robocze"""
+        notices = []
+        while self.notices:
+            notices.append(self.notices.popleft())
+        return notices
 
     def _rate_limit_check(self):
-        now = time.time()
-        self.request_timestamps = [t for t in self.request_timestamps if t > now - 1]
-        if len(self.request_timestamps) >= 5:
-            sleep_time = 1.0 - (now - self.request_timestamps[0])
-            if sleep_time > 0:
-                time.sleep(sleep_time + random.uniform(0.1, 0.3))
-        self.request_timestamps.append(time.time())
+        wait = self._cooldown_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.bucket.acquire()
+
+    def _set_cooldown(self, until: float) -> bool:
+        """Przedłuż wspólną przerwę; True, jeśli to wywołanie ją wydłużyło"""
+        with self._lock:
+            if until <= self._cooldown_until:
+                return False
+            self._cooldown_until = until
+            return True
+
+    def _note_rate_headers(self, resp: requests.Response):
+        """Wstrzymaj wszystkie wątki, zanim serwer zacznie odpowiadać 429 lub gdy prosi o przerwę po 5xx"""
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        reset = resp.headers.get("X-RateLimit-Reset")
+        if remaining is not None and reset is not None:
+            try:
+                if int(remaining) <= 0:
+                    reset_at = float(reset)
+                    now = time.time()
+                    if reset_at < 1e9:  # liczba sekund do resetu, nie znacznik czasu
+                        reset_at += now
+                    wait = min(max(0.0, reset_at - now), RATE_LIMIT_MAX_COOLDOWN)
+                    # Ten sam reset widzi kilka wątków naraz - komunikat tylko raz
+                    if wait > 0 and self._set_cooldown(now + wait):
+                        self._notify("warning", f"⏳ Wyczerpany limit API. Czekam {wait:.0f}s…")
+            except ValueError:
+                pass
+        if resp.status_code >= 500:
+            wait = _retry_after(resp.headers.get("Retry-After"))
+            if wait is not None:
+                self._set_cooldown(time.time() + wait)
 
     def _handle_rate_limit(self, resp: requests.Response) -> bool:
+        self._note_rate_headers(resp)
+        if resp.ok:
+            self.bucket.success()
         if resp.status_code == 429:
             retry_after = None
             try:
-                retry_after = float(resp.json().get("wait"))
+                retry_after = float(_json(resp).get("wait"))
             except:
                 pass
             if retry_after is None:
-                retry_after = float(resp.headers.get("Retry-After", 60))
-            st.warning(f"⏳ Przekroczono limit. Czekam {retry_after:.0f}s…")
-            sleep_time = retry_after if self.strict_backoff else retry_after + random.uniform(0.5, 1.5)
-            time.sleep(sleep_time)
+                retry_after = _retry_after(resp.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = 60.0
+            self.bucket.slow_down(retry_after)
+            self._notify("warning", f"⏳ Przekroczono limit. Czekam {retry_after:.0f}s…")
+            # Wspólny cooldown wstrzymuje wszystkie wątki naraz - losowy rozrzut nie jest potrzebny
+            self._set_cooldown(time.time() + retry_after)
+            time.sleep(retry_after)
             return True
         return False
 
-    def _search(self, domain: str, field: str, values: List[str], exclude: List[str], 
+    def _search(self, ctx: RunContext, domain: str, field: str, values: List[str], exclude: List[str], 
                 exclude_departments: List[str], management_levels: Optional[List[str]] = None, 
-                country: Optional[str] = None) -> List[Dict]:
-        self._rate_limit_check()
-        if not domain.startswith(("http://", "https://")):
-            domain = "https://" + domain
-        clean_values = [v.strip() for v in values if v.strip()]
-        if not clean_values:
-            return []
+                country: Optional[str] = None) -> Iterator[Candidate]:
+        # domain jest już znormalizowany w search_with_emails, a listy i kraj
+        # oczyszczone w main() (albo są stałymi modułu)
+        if not values:
+            return
         
         # Podstawowa struktura query
         payload = {
@@ -156,24 +470,24 @@ class RocketReachAPI:
                 "company_domain": [domain]
             },
             "start": 1,
-            "page_size": 50
+            "page_size": SEARCH_PAGE_SIZE
         }
         
         # Dodaj główne pole wyszukiwania
-        payload["query"][field] = clean_values
+        payload["query"][field] = values
         
         # Dodaj wykluczenia (stanowiska)
         if exclude:
             if field == "current_title":
-                payload["query"]["exclude_current_title"] = [e.strip() for e in exclude if e.strip()]
+                payload["query"]["exclude_current_title"] = exclude
             elif field == "skills":
-                payload["query"]["exclude_skills"] = [e.strip() for e in exclude if e.strip()]
+                payload["query"]["exclude_skills"] = exclude
             elif field == "management_levels":
-                payload["query"]["exclude_current_title"] = [e.strip() for e in exclude if e.strip()]
+                payload["query"]["exclude_current_title"] = exclude
         
         # Dodaj wykluczenia departments na każdym etapie
         if exclude_departments:
-            payload["query"]["exclude_department"] = [d.strip() for d in exclude_departments if d.strip()]
+            payload["query"]["exclude_department"] = exclude_departments
         
         # Dodaj management levels jeśli wybrane (jako dodatkowy filtr dla etapów 1-3)
         if management_levels and field != "management_levels":
@@ -181,70 +495,124 @@ class RocketReachAPI:
         
         # Dodaj filtr kraju jeśli podany
         if country:
-            payload["query"]["company_country_code"] = [country.strip()]
+            payload["query"]["company_country_code"] = [country]
 
-        for attempt in range(3):
-            resp = requests.post(f"{self.base_url}/person/search", headers=self.headers, json=payload)
+        key = (domain, field, tuple(values), tuple(exclude), tuple(exclude_departments),
+               tuple(management_levels or ()), country)
+        profiles = self._recall(ctx, self.search_cache, key)
+        # Trafienie w cache = żadnego zapytania do API
+        for attempt in range(3 if profiles is None else 0):
+            if attempt == 0:
+                body = _dumps(payload)  # serializujemy raz, nie przy każdej próbie
+            self._rate_limit_check()
+            resp = self.session.post(f"{self.base_url}/person/search", data=body,
+                                     timeout=REQUEST_TIMEOUT)
             if self._handle_rate_limit(resp):
                 continue
             if resp.status_code == 201:
-                profiles = resp.json().get("profiles", [])
-                return [
-                    {
-                        "id": p["id"],
-                        "name": p["name"],
-                        "title": p.get("current_title", ""),
-                        "linkedin": p.get("linkedin_url", ""),
-                        "management_level": p.get("management_level", "")
-                    }
-                    for p in profiles[:15]  # Limit na 15 profili
-                ]
+                profiles = _json(resp).get("profiles", [])
+                self._remember(ctx, self.search_cache, key, profiles)
+                break
             elif resp.status_code == 400:
                 try:
-                    error_msg = resp.json()
-                    st.error(f"❌ Search API error 400: {error_msg}")
+                    error_msg = _json(resp)
+                    self._notify("error", f"❌ Search API error 400: {error_msg}")
                 except:
-                    st.error(f"Search API error 400: Bad request")
-                return []
+                    self._notify("error", f"Search API error 400: Bad request")
+                return
             else:
-                st.error(f"Search API error {resp.status_code}")
+                self._notify("error", f"Search API error {resp.status_code}")
                 break
-        return []
 
-    def _lookup(self, person_id: int) -> Dict:
-        self._rate_limit_check()
+        # Generator - kandydaci budowani leniwie, wołający sam ucina listę
+        for p in profiles or []:
+            yield Candidate(
+                id=p["id"],
+                name=p["name"],
+                title=p.get("current_title", ""),
+                linkedin=p.get("linkedin_url", ""),
+                management_level=p.get("management_level", "")
+            )
+
+    def _recall(self, ctx: RunContext, cache: LRUCache, key):
+        """Wynik z pamięci, a gdy go tam nie ma - z dysku"""
+        if ctx.refresh:
+            # Tylko to, co pobrało to uruchomienie (klucze lookupów i wyszukiwań się nie mieszają)
+            value = ctx.fresh.get(key)
+        else:
+            value = cache.get(key)
+            if value is None and self.disk_cache is not None:
+                value = self.disk_cache.get(key)
+                if value is not None:
+                    cache[key] = value
+        if value is not None:
+            ctx.hit()
+        return value
+
+    def _remember(self, ctx: RunContext, cache: LRUCache, key, value):
+        if ctx.refresh:
+            ctx.fresh[key] = value
+        cache[key] = value
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, value, expire=DISK_CACHE_TTL)
+
+    def clear_cache(self):
+        """Zapomnij wszystkie wyszukiwania i lookupy - w pamięci i na dysku"""
+        self.lookup_cache.clear()
+        self.search_cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
+
+    def _lookup(self, ctx: RunContext, person_id: int) -> Dict:
+        cached = self._recall(ctx, self.lookup_cache, person_id)
+        if cached is not None:
+            return cached
         for _ in range(3):
-            resp = requests.get(
+            self._rate_limit_check()
+            resp = self.session.get(
                 f"{self.base_url}/person/lookup",
-                headers=self.headers,
-                params={"id": person_id, "lookup_type": "standard"}
+                params={"id": person_id, "lookup_type": "standard"},
+                timeout=REQUEST_TIMEOUT
             )
             if self._handle_rate_limit(resp):
                 continue
             if resp.status_code == 200:
-                return resp.json()
+                data = _json(resp)
+                self._remember(ctx, self.lookup_cache, person_id, data)
+                return data
+            if resp.status_code == 404:
+                # Osoby nie ma - zapamiętujemy pusty wynik, żeby nie pytać drugi raz
+                self._remember(ctx, self.lookup_cache, person_id, {})
+            else:
+                # Zły klucz, brak kredytów (401/402/403) czy błąd 5xx nie mówią nic
+                # o osobie - nie trafiają do cache, tylko do komunikatów
+                self._notify("error", f"Lookup API error {resp.status_code}")
             break
         return {}
 
+    def _lookup_many(self, ctx: RunContext, ids: List[int]) -> Iterator[Dict]:
+        """Lookup paczki osób naraz - każde id tylko raz, wyniki w kolejności ids"""
+        return self._lookup_pool.map(partial(self._lookup, ctx), dict.fromkeys(ids))
+
     def _process(self, data: Dict) -> Dict:
         if not data:
             return {}
         
-        grade_order = {"A": 1, "A-": 2, "B": 3, "B-": 4, "C": 5, "D": 6, "F": 7}
         email = data.get("recommended_professional_email") or data.get("current_work_email")
-        email_obj = {}
+        emails = data.get("emails") or []
         
         if not email:
-            professional_emails = [
-                e for e in data.get("emails", [])
-                if e.get("type") == "professional" and e.get("smtp_valid") != "invalid"
-            ]
-            if not professional_emails:
+            # Potrzebny tylko najlepszy grade - min() zamiast sortowania całej listy
+            email_obj = min(
+                (e for e in emails
+                 if e.get("type") == "professional" and e.get("smtp_valid") != "invalid"),
+                key=lambda e: _GRADE_ORDER.get(e.get("grade", "F"), 99),
+                default=None
+            )
+            if email_obj is None:
                 return {}
-            professional_emails.sort(key=lambda e: grade_order.get(e.get("grade", "F"), 99))
-            email_obj = professional_emails[0]
         else:
-            email_obj = next((e for e in data.get("emails", []) if e.get("email") == email), 
+            email_obj = next((e for e in emails if e.get("email") == email), 
                            {"email": email, "grade": "", "smtp_valid": ""})
 
         if email_obj.get("smtp_valid") == "invalid":
@@ -271,77 +639,83 @@ class RocketReachAPI:
         }
         return priority_map.get(management_level, 0)
 
-    def search_with_emails(self, domain: str, titles: List[str], departments: List[str], 
+    def _collect(self, ctx: RunContext, candidates: Iterable[Candidate], label: str,
+                 valid_contacts: List[Dict], seen_emails: set, seen_ids: set, log: List[str]):
+        """Lookup kandydatów w równoległych paczkach, dopóki nie ma 3 kontaktów"""
+        # Osoby sprawdzone we wcześniejszym etapie pomijamy - miejsce w paczce dostaje nowy kandydat
+        candidates = (c for c in itertools.islice(candidates, CANDIDATES_PER_SEARCH)
+                      if c.id not in seen_ids)
+        while len(valid_contacts) < 3:
+            # Paczka ma tyle osób, ile brakuje kontaktów - nie płacimy za zbędne lookupy
+            ids = [c.id for c in itertools.islice(candidates, 3 - len(valid_contacts))]
+            if not ids:
+                break
+            seen_ids.update(ids)
+            for detail in self._lookup_many(ctx, ids):
+                processed = self._process(detail)
+                if processed and processed["email"] not in seen_emails:
+                    valid_contacts.append(processed)
+                    seen_emails.add(processed["email"])
+                    log.append(
+                        f"✅ Kontakt ({label}): {processed['name']} ({processed['title']}) | "
+                        f"{processed['email']} (Grade:{processed['email_grade']}, SMTP:{processed['smtp_valid']})"
+                    )
+
+    def search_with_emails(self, ctx: RunContext, domain: str, titles: List[str], departments: List[str], 
                           exclude: List[str], management_levels_filter: Optional[List[str]], 
                           country: Optional[str]) -> List[Dict]:
         valid_contacts = []
         seen_emails = set()
+        seen_ids = set()
+        # Komunikaty zbierane lokalnie i renderowane raz na domenę
+        log: List[str] = []
+
+        # Normalizacja raz na domenę - wszystkie etapy widzą ten sam URL
+        domain = "https://" + extract_domain(domain)
+
+        skills_search = partial(self._search, ctx, domain, "skills", SKILLS_FOR_SEARCH, exclude,
+                                DEPARTMENTS_TO_EXCLUDE, management_levels_filter, country)
+        skills_prefetch = None
 
         # ETAP 1: Keywords stanowisk (BEZ DEPARTMENTS_TO_EXCLUDE)
         if titles and len(valid_contacts) < 3:
-            st.info("🔍 Etap 1: wyszukiwanie po keywords stanowisk...")
-            candidates = self._search(domain, "current_title", titles, exclude, 
-                                     [], management_levels_filter, country)
-            for c in candidates:
-                if len(valid_contacts) >= 3:
-                    break
-                detail = self._lookup(c["id"])
-                processed = self._process(detail)
-                if processed and processed["email"] not in seen_emails:
-                    valid_contacts.append(processed)
-                    seen_emails.add(processed["email"])
-                    st.success(
-                        f"✅ Kontakt (keywords): {processed['name']} ({processed['title']}) | "
-                        f"{processed['email']} (Grade:{processed['email_grade']}, SMTP:{processed['smtp_valid']})"
-                    )
+            log.append("🔍 Etap 1: wyszukiwanie po keywords stanowisk...")
+            candidates = list(itertools.islice(
+                self._search(ctx, domain, "current_title", titles, exclude,
+                             [], management_levels_filter, country),
+                CANDIDATES_PER_SEARCH))
+            # Mniej niż 3 kandydatów = etap 2 na pewno będzie potrzebny - jego
+            # wyszukiwanie idzie równolegle z lookupami etapu 1
+            if len(candidates) < 3 and SKILLS_FOR_SEARCH:
+                skills_prefetch = self._lookup_pool.submit(
+                    lambda: list(itertools.islice(skills_search(), CANDIDATES_PER_SEARCH)))
+            self._collect(ctx, candidates, "keywords", valid_contacts, seen_emails, seen_ids, log)
 
         # ETAP 2: Skills (z filtrem management_levels)
         if len(valid_contacts) < 3 and SKILLS_FOR_SEARCH:
-            st.info("🎯 Etap 2: wyszukiwanie po skills...")
-            candidates = self._search(domain, "skills", SKILLS_FOR_SEARCH, exclude, 
-                                     DEPARTMENTS_TO_EXCLUDE, management_levels_filter, country)
-            for c in candidates:
-                if len(valid_contacts) >= 3:
-                    break
-                detail = self._lookup(c["id"])
-                processed = self._process(detail)
-                if processed and processed["email"] not in seen_emails:
-                    valid_contacts.append(processed)
-                    seen_emails.add(processed["email"])
-                    st.success(
-                        f"✅ Kontakt (skills): {processed['name']} ({processed['title']}) | "
-                        f"{processed['email']} (Grade:{processed['email_grade']}, SMTP:{processed['smtp_valid']})"
-                    )
+            log.append("🎯 Etap 2: wyszukiwanie po skills...")
+            candidates = skills_prefetch.result() if skills_prefetch else skills_search()
+            self._collect(ctx, candidates, "skills", valid_contacts, seen_emails, seen_ids, log)
 
         # ETAP 3: Departments (z filtrem management_levels)
         if len(valid_contacts) < 3 and departments:
-            st.info("🔍 Etap 3: wyszukiwanie po departments...")
-            candidates = self._search(domain, "department", departments, exclude, 
+            log.append("🔍 Etap 3: wyszukiwanie po departments...")
+            candidates = self._search(ctx, domain, "department", departments, exclude, 
                                      DEPARTMENTS_TO_EXCLUDE, management_levels_filter, country)
-            for c in candidates:
-                if len(valid_contacts) >= 3:
-                    break
-                detail = self._lookup(c["id"])
-                processed = self._process(detail)
-                if processed and processed["email"] not in seen_emails:
-                    valid_contacts.append(processed)
-                    seen_emails.add(processed["email"])
-                    st.success(
-                        f"✅ Kontakt (department): {processed['name']} ({processed['title']}) | "
-                        f"{processed['email']} (Grade:{processed['email_grade']}, SMTP:{processed['smtp_valid']})"
-                    )
+            self._collect(ctx, candidates, "department", valid_contacts, seen_emails, seen_ids, log)
 
         # ETAP 4: Management Levels - STAŁY FILTR z SORTOWANIEM po priorytecie
         if len(valid_contacts) < 3:
-            st.info("👔 Etap 4: wyszukiwanie po management levels (priorytet: Founder/Owner, C-Level)...")
+            log.append("👔 Etap 4: wyszukiwanie po management levels (priorytet: Founder/Owner, C-Level)...")
             fixed_levels = ["Founder/Owner", "C-Level", "Vice President", "Head", "Director"]
-            candidates = self._search(domain, "management_levels", fixed_levels, exclude, 
+            candidates = self._search(ctx, domain, "management_levels", fixed_levels, exclude, 
                                      DEPARTMENTS_TO_EXCLUDE, None, country)
             
             # Sortuj kandydatów po priorytecie (Founder/Owner i C-Level pierwszy)
             candidates_with_priority = []
-            for c in candidates:
-                detail = self._lookup(c["id"])
+            ids = [c.id for c in itertools.islice(candidates, CANDIDATES_PER_SEARCH)
+                   if c.id not in seen_ids]
+            for detail in self._lookup_many(ctx, ids):
                 processed = self._process(detail)
                 if processed and processed["email"] not in seen_emails:
                     priority = self._get_priority_score(processed.get("management_level", ""))
@@ -357,19 +731,88 @@ class RocketReachAPI:
                 valid_contacts.append(processed)
                 seen_emails.add(processed["email"])
                 priority_label = "🌟 (Founder/Owner lub C-Level)" if priority == 10 else "⭐ (VP/Head/Director)"
-                st.success(
+                log.append(
                     f"✅ Kontakt (management) {priority_label}: {processed['name']} ({processed['title']}) | "
                     f"{processed['email']} (Grade:{processed['email_grade']}, SMTP:{processed['smtp_valid']})"
                 )
 
-        st.info(f"📊 Łącznie: {len(valid_contacts)} kontaktów")
+        log.append(f"📊 Łącznie: {len(valid_contacts)} kontaktów")
+        # Domeny kończą się w dowolnej kolejności, więc blok zaczyna się od nazwy domeny
+        self._notify("markdown", f"**{domain}**\n" + "\n".join(f"- {line}" for line in log))
         return valid_contacts[:3]
 
 
+def iter_completed(executor: ThreadPoolExecutor, fn: Callable, items: List, window: int) -> Iterator:
+    """Jak as_completed, ale w kolejce executora jest najwyżej `window` zadań.
+
+    Zwraca pary (indeks elementu, future). Przerwanie skryptu przez Streamlit
+    nie zostawia wtedy w tle przetwarzania reszty pliku CSV.
+    """
+    queue = iter(enumerate(items))
+    pending = {}
+    while True:
+        for idx, item in itertools.islice(queue, window - len(pending)):
+            pending[executor.submit(fn, item)] = idx
+        if not pending:
+            return
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield pending.pop(future), future
+
+
+@st.cache_data(show_spinner=False)
+def load_domains(data: bytes) -> Tuple[pd.DataFrame, List[str], List[str], int]:
+    """Podgląd CSV, poprawne wiersze z ich hostami i liczba odrzuconych - raz na plik"""
+    # Potrzebna tylko pierwsza kolumna - bez inferencji typów i NaN. dtype=object, a nie str:
+    # przy pyarrow .str działa na RE2, gdzie \w to tylko ASCII i domeny IDN by odpadały
+    df_in = pd.read_csv(io.BytesIO(data), usecols=[0], dtype=object, engine="c", na_filter=False)
+    # Hosty dla całej kolumny jednym przebiegiem .str (ten sam wzorzec co extract_domain)
+    websites = df_in.iloc[:, 0].str.strip()
+    hosts = websites.str.lower().str.extract(_DOMAIN_RE, expand=False)
+    # Puste wiersze i śmieci ("n/a", "brak strony"...) odpadają przed jakimkolwiek zapytaniem
+    keep = hosts.str.fullmatch(_HOST_RE)
+    invalid = int((hosts.ne("") & ~keep).sum())
+    return df_in.head(), websites[keep].tolist(), hosts[keep].tolist(), invalid
+
+
+@st.cache_resource(show_spinner=False)
+def get_api(api_key: str) -> RocketReachAPI:
+    """Klient API wspólny dla kolejnych uruchomień - sesja, limiter i cache przeżywają rerun"""
+    return RocketReachAPI(api_key)
+
+
+def _text_cell(sheet, value: str) -> WriteOnlyCell:
+    """Komórka tekstowa - openpyxl zapisałby tekst zaczynający się od "=" jako formułę"""
+    cell = WriteOnlyCell(sheet, value=value)
+    cell.data_type = "s"
+    return cell
+
+
+@st.cache_data(show_spinner=False)
 def create_excel(results_df: pd.DataFrame) -> bytes:
     out = io.BytesIO()
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
-        results_df.to_excel(writer, index=False, sheet_name="Kontakty")
+    if xlsxwriter is not None:
+        # constant_memory wymaga zapisu wiersz po wierszu (to_excel pisze kolumnami),
+        # więc wiersze podajemy sami - w pamięci trzymany jest tylko bieżący.
+        # Bez zgadywania typów: URL-e i teksty zaczynające się od "=" zostają zwykłym
+        # tekstem (tak samo w ścieżce openpyxl niżej), a limit 65 530 hiperłączy nie gubi komórek
+        workbook = xlsxwriter.Workbook(out, {"constant_memory": True,
+                                             "strings_to_urls": False,
+                                             "strings_to_formulas": False})
+        sheet = workbook.add_worksheet("Kontakty")
+        sheet.write_row(0, 0, results_df.columns)
+        for r, row in enumerate(results_df.itertuples(index=False), 1):
+            sheet.write_row(r, 0, row)
+        workbook.close()
+        return out.getvalue()
+    # Bez xlsxwriter: openpyxl write_only - wiersze idą prosto do XML, bez obiektów komórek
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Kontakty")
+    sheet.append(list(results_df.columns))
+    for row in results_df.itertuples(index=False):
+        sheet.append([_text_cell(sheet, v) if isinstance(v, str) and v.startswith("=") else v
+                      for v in row])
+    workbook.save(out)
     return out.getvalue()
 
 
@@ -416,69 +859,156 @@ def main():
             "Kod kraju (puste = bez ograniczeń)",
             placeholder="np. US, PL, GB"
         )
+        
+        rate_limit = st.number_input(
+            "Limit zapytań na sekundę (wg planu RocketReach)",
+            min_value=RATE_LIMIT_MIN_PER_SEC,
+            value=RATE_LIMIT_PER_SEC,
+            step=0.5
+        )
+        
+        refresh = st.checkbox("Pomiń cache (pobierz świeże dane z API)")
+        
+        # Cache na dysku żyje 7 dni - tu można go wyczyścić bez usuwania katalogu ręcznie
+        if st.button("🗑️ Wyczyść cache", disabled=not api_key):
+            get_api(api_key).clear_cache()
+            st.success("Cache wyczyszczony")
+
+    # Pola tekstowe czyścimy raz, a nie przy każdej domenie i każdym etapie
+    titles = [t.strip() for t in titles if t.strip()]
+    exclude = [e.strip() for e in exclude if e.strip()]
+    country = country.strip()
 
     source = st.radio("Źródło domen", ["CSV", "Manual"])
     domains: List[str] = []
+    hosts: List[str] = []
     
     if source == "CSV":
         uploaded = st.file_uploader("Wgraj plik CSV z domenami", type="csv")
         if uploaded:
-            df_in = pd.read_csv(uploaded)
-            domains = df_in.iloc[:, 0].dropna().tolist()
-            st.dataframe(df_in.head())
+            preview, domains, hosts, invalid = load_domains(uploaded.getvalue())
+            st.dataframe(preview)
+            if invalid:
+                st.info(f"ℹ️ Pominięto {invalid} wierszy, które nie wyglądają na domenę")
+            duplicates = len(hosts) - len(set(hosts))
+            if duplicates:
+                st.info(f"ℹ️ {duplicates} powtórzonych domen zostanie wyszukanych tylko raz")
     else:
         manual = st.text_input("Wpisz domenę (np. https://example.com)")
         if manual:
-            domains = [manual.strip()]
+            host = extract_domain(manual)
+            if _HOST_RE.fullmatch(host):
+                domains = [manual.strip()]
+                hosts = [host]
+            else:
+                st.warning("⚠️ To nie wygląda na domenę")
 
     if not api_key:
         st.warning("⚠️ Wprowadź klucz API RocketReach")
     elif not domains:
         st.info("📝 Podaj przynajmniej jedną domenę")
     elif st.button("🚀 Rozpocznij wyszukiwanie"):
-        rr = RocketReachAPI(api_key)
-        results = []
+        rr = get_api(api_key)
+        # Komunikaty po przerwanym wcześniejszym uruchomieniu nie dotyczą tego wyszukiwania
+        rr.drain_notices()
+        rr.bucket.set_rate(rate_limit)
+        # Stan tego uruchomienia - klient z get_api dzielą wszystkie sesje
+        ctx = RunContext(refresh=refresh)
+        # Wyniki trzymamy kolumnami w kolejności wejściowej, choć domeny kończą się
+        # w dowolnej - DataFrame budujemy na końcu raz, z dict-of-lists
+        n = len(domains)
+        columns: Dict[str, List[str]] = {name: [""] * n for name in RESULT_COLUMNS}
+        columns["Website"] = list(domains)
+        # Listy kolumn każdej osoby wyszukane raz - w pętli tylko przypisanie
+        slots = [[(columns[name], key) for name, key in slot] for slot in CONTACT_SLOTS]
+        found = [0] * n
+        # Ta sama firma (z www., ze ścieżką...) jest wyszukiwana raz, a wynik
+        # trafia do wszystkich jej wierszy
+        rows_by_host: Dict[str, List[int]] = {}
+        for row, host in enumerate(hosts):
+            rows_by_host.setdefault(host, []).append(row)
+        unique_hosts = list(rows_by_host)
+        total = len(unique_hosts)
         progress = st.progress(0)
+        # Pasek i log odświeżamy wg czasu, a nie przy każdej domenie
+        last_refresh = 0.0
+        # Raporty domen trafiają do jednego elementu zamiast nowego st.markdown na domenę
+        log_box = st.empty()
+        recent: Deque[str] = deque(maxlen=LOG_LINES)
+        # Podgląd wierszy już ukończonych - użytkownik widzi wyniki przed końcem
+        partial_box = st.empty()
+        done_rows: List[int] = []
         
-        for idx, domain in enumerate(domains):
-            contacts = rr.search_with_emails(
-                domain, 
-                titles, 
-                selected_departments,
-                exclude, 
-                selected_management_levels if selected_management_levels else None,
-                country if country.strip() else None
+        # Domeny przetwarzane równolegle - limiter w RocketReachAPI pilnuje tempa
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            search = partial(
+                rr.search_with_emails,
+                ctx,
+                titles=titles,
+                departments=selected_departments,
+                exclude=exclude,
+                management_levels_filter=selected_management_levels if selected_management_levels else None,
+                country=country or None
             )
-            row = {"Website": domain, "Status": f"Znaleziono {len(contacts)} kontakt(ów)"}
-            for i in range(1, 4):
-                c = contacts[i - 1] if i - 1 < len(contacts) else {}
-                row.update({
-                    f"Name {i}": c.get("name", ""),
-                    f"Title {i}": c.get("title", ""),
-                    f"Email {i}": c.get("email", ""),
-                    f"LinkedIn {i}": c.get("linkedin", ""),
-                    f"Grade {i}": c.get("email_grade", "")
-                })
-            results.append(row)
-            progress.progress((idx + 1) / len(domains))
-            if idx < len(domains) - 1:
-                time.sleep(random.uniform(1, 2))
-
-        df_out = pd.DataFrame(results)
+            completed = iter_completed(executor, search, unique_hosts, window=2 * MAX_WORKERS)
+            for done, (idx, future) in enumerate(completed, 1):
+                try:
+                    contacts = future.result()
+                    status = f"Znaleziono {len(contacts)} kontakt(ów)"
+                except requests.RequestException as e:
+                    contacts = []
+                    status = f"Błąd: {e}"
+                done_rows.extend(rows_by_host[unique_hosts[idx]])
+                for row in rows_by_host[unique_hosts[idx]]:
+                    columns["Status"][row] = status
+                    found[row] = len(contacts)
+                    for slot, c in zip(slots, contacts):
+                        for target, key in slot:
+                            target[row] = c.get(key, "")
+                for level, message in rr.drain_notices():
+                    if level == "markdown":
+                        recent.append(message)
+                    else:
+                        getattr(st, level)(message)
+                now = time.monotonic()
+                if now - last_refresh >= UI_REFRESH_INTERVAL or done == total:
+                    log_box.markdown("\n\n".join(recent))
+                    progress.progress(done / total)
+                    last_refresh = now
+                if done % PARTIAL_EVERY == 0 and len(done_rows) <= PREVIEW_ROWS:
+                    partial_box.dataframe(
+                        pd.DataFrame({name: [col[r] for r in done_rows] for name, col in columns.items()}),
+                        use_container_width=True
+                    )
+        # Pełna tabela jest renderowana niżej
+        partial_box.empty()
+
+        # Wyniki przeżywają rerun (np. kliknięcie pobierania) - bez ponownego wyszukiwania
+        st.session_state.results_df = pd.DataFrame(columns)
+        st.session_state.found = found
+        st.session_state.cache_hits = ctx.cache_hits
+
+    df_out = st.session_state.get("results_df")
+    if df_out is not None:
+        found = st.session_state.found
         st.subheader("📋 Wyniki wyszukiwania")
-        st.dataframe(df_out, use_container_width=True)
+        st.dataframe(df_out.head(PREVIEW_ROWS), use_container_width=True)
+        if len(df_out) > PREVIEW_ROWS:
+            st.caption(f"Pokazano {PREVIEW_ROWS} z {len(df_out)} wierszy - pełne wyniki w pliku Excel")
         
         # Statystyki
         st.subheader("📊 Statystyki")
-        total_contacts = sum(1 for r in results for i in range(1, 4) if r.get(f"Email {i}"))
-        col1, col2, col3 = st.columns(3)
+        total_contacts = sum(found)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Przeanalizowane firmy", len(domains))
+            st.metric("Przeanalizowane firmy", len(df_out))
         with col2:
             st.metric("Znalezione kontakty", total_contacts)
         with col3:
-            firms_with_contacts = sum(1 for r in results if "Znaleziono" in r["Status"] and int(r["Status"].split()[1]) > 0)
+            firms_with_contacts = sum(1 for f in found if f)
             st.metric("Firmy z kontaktami", firms_with_contacts)
+        with col4:
+            st.metric("Zapytania z cache", st.session_state.cache_hits)
         
         excel_data = create_excel(df_out)
         st.download_button(